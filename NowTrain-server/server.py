@@ -8,30 +8,69 @@ Realtime Train SSE Server (FastAPI) - 完全版
 """
 
 import asyncio
+import hashlib
 import json
+import logging
 import os
+import pickle
+import sys
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Any, Dict, List, Optional
 
 import httpx
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+import numpy as np
+import orjson
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import math
 
 load_dotenv()
 
+# ログ設定: ホットパスでの同期stdout書き込みを避けるためprintではなくloggingを使う
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logger = logging.getLogger("nowtrain")
+
 # 設定
 ODPT_BASE = os.getenv("ODPT_BASE", "https://api-challenge.odpt.org/api/v4")
 ODPT_KEY = os.getenv("ODPT_CONSUMER_KEY", "")
 POLL_INTERVAL_SEC = int(os.getenv("POLL_INTERVAL_SEC", "3"))
 SSE_HEARTBEAT_SEC = int(os.getenv("SSE_HEARTBEAT_SEC", "1"))
+SSE_COALESCE_SEC = float(os.getenv("SSE_COALESCE_SEC", "0.05"))
+
+# SSEフレームの固定部分（emitごとにf-stringを組み立てず、bytes連結1回で済ませる）
+SSE_SNAPSHOT_PREFIX = b"event: snapshot\ndata: "
+SSE_DELTA_PREFIX = b"event: delta\ndata: "
+SSE_PING_PREFIX = b"event: ping\ndata: "
+SSE_TERM = b"\n\n"
+
+# SSE応答の共通ヘッダ（接続ごとにdictを組み立てない。プロキシのバッファリングも抑止）
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Content-Type": "text/event-stream",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
 TTL_SEC = int(os.getenv("TTL_SEC", "15"))
+STATIC_REFRESH_SEC = int(os.getenv("STATIC_REFRESH_SEC", str(12 * 3600)))
+
+# 配信対象路線（JR東日本の主要路線）
+TARGET_RAILWAYS = [
+    "odpt.Railway:JR-East.ChuoSobuLocal",
+    "odpt.Railway:JR-East.ChuoRapid",
+    "odpt.Railway:JR-East.Yamanote",
+]
 
 # 正規化ユーティリティ
+# 入力は毎tick同じIDの繰り返しなので結果をメモ化する
+@lru_cache(maxsize=8192)
 def normalize_railway_id(raw: str) -> str:
     if not raw:
         return raw
@@ -39,6 +78,7 @@ def normalize_railway_id(raw: str) -> str:
         return raw.split(":", 1)[1]
     return raw
 
+@lru_cache(maxsize=8192)
 def normalize_trip_id(raw: str) -> str:
     if not raw:
         return raw
@@ -50,8 +90,12 @@ def normalize_trip_id(raw: str) -> str:
         parts = parts[:-1]
     return ".".join(parts)
 
+@lru_cache(maxsize=16384)
 def time_to_seconds(time_str: str) -> int:
-    """HH:mm:ss を秒に変換（24時超対応）"""
+    """HH:mm:ss を秒に変換（24時超対応）
+
+    同じ時刻文字列がロード・取り込みで何度も現れるため結果をメモ化する。
+    """
     if not time_str:
         return 0
     parts = time_str.split(":")
@@ -63,7 +107,11 @@ def time_to_seconds(time_str: str) -> int:
 def unix_ts() -> int:
     return int(time.time())
 
-# スキーマ
+def today_midnight_epoch() -> int:
+    """今日の00:00:00のUNIX秒"""
+    return int(datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+# スキーマ（OpenAPIドキュメント用。内部キャッシュはplain dictで持つ）
 class Vehicle(BaseModel):
     trip_id: str
     lat: Optional[float] = None
@@ -85,12 +133,11 @@ class Snapshot(BaseModel):
 
 # ODPT API
 async def odpt_get(client: httpx.AsyncClient, path: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
-    p = {"acl:consumerKey": ODPT_KEY}
-    p.update(params)
-    url = f"{ODPT_BASE}/{path}"
-    r = await client.get(url, params=p, timeout=30)
+    # acl:consumerKey・base_url・タイムアウトはクライアント側のデフォルトに設定済み
+    r = await client.get(f"/{path}", params=params)
     r.raise_for_status()
-    return r.json()
+    # 大きな応答ではstdlib jsonより数倍速い
+    return orjson.loads(r.content)
 
 async def fetch_odpt_stations(client: httpx.AsyncClient, railway_id: Optional[str] = None) -> List[Dict[str, Any]]:
     params = {}
@@ -119,85 +166,162 @@ class GTFSLoader:
         self.gtfs_dir = Path(gtfs_dir)
         self.stops = {}           # stop_id → {lat, lng, name}
         self.trips = {}           # trip_id → {route_id, headsign}
-        self.stop_times = {}      # trip_id → [{stop_id, arrival, departure, sequence}, ...]
+        # trip_id → {"stop_ids": tuple, "arr": int32配列(秒), "dep": int32配列(秒), "idx": {stop_id → 停車順index}}
+        # 欠損時刻は-1。SoA化でホットパスの時刻文字列パースと線形探索を排除する
+        self.stop_times = {}
         self.routes = {}          # route_id → {name, color}
+        self.trips_by_number = {} # 列車番号 → [trip_id, ...] の逆引きインデックス
 
         self.load_all()
 
+    GTFS_FILES = ("stops.json", "routes.json", "trips.json", "stop_times.json")
+
+    def _cache_path(self):
+        """GTFSファイルのmtime+sizeから導出するスナップショットのパス（取得不可ならNone）"""
+        try:
+            sig = ";".join(
+                f"{name}:{os.stat(self.gtfs_dir / name).st_mtime_ns}:{os.stat(self.gtfs_dir / name).st_size}"
+                for name in self.GTFS_FILES
+            )
+        except OSError:
+            return None
+        key = hashlib.blake2b(sig.encode()).hexdigest()[:32]
+        return self.gtfs_dir / ".cache" / f"{key}.pkl"
+
+    def _load_snapshot(self, cache_path) -> bool:
+        """pickleスナップショットから復元できたらTrue"""
+        try:
+            with open(cache_path, "rb") as f:
+                snap = pickle.load(f)
+            if snap.get("v") != 2:
+                return False
+            self.stops = snap["stops"]
+            self.trips = snap["trips"]
+            self.stop_times = snap["stop_times"]
+            self.routes = snap["routes"]
+            self.trips_by_number = snap["trips_by_number"]
+            return True
+        except Exception as e:
+            logger.warning("[GTFS] Failed to load snapshot %s: %s", cache_path, e)
+            return False
+
+    def _save_snapshot(self, cache_path) -> None:
+        try:
+            cache_path.parent.mkdir(exist_ok=True)
+            tmp_path = cache_path.with_suffix(".tmp")
+            with open(tmp_path, "wb") as f:
+                pickle.dump({
+                    "v": 2,
+                    "stops": self.stops,
+                    "trips": self.trips,
+                    "stop_times": self.stop_times,
+                    "routes": self.routes,
+                    "trips_by_number": self.trips_by_number,
+                }, f, protocol=5)
+            os.replace(tmp_path, cache_path)
+            logger.info("[GTFS] Saved snapshot to %s", cache_path)
+        except Exception as e:
+            logger.warning("[GTFS] Failed to save snapshot: %s", e)
+
     def load_all(self):
         """全GTFSファイルを読み込み"""
-        print("[GTFS] Loading static data...")
+        logger.info("[GTFS] Loading static data...")
+
+        # 元ファイルが変わっていなければpickleスナップショットから即復元
+        # （JSONパース + Pythonオブジェクト構築を丸ごとスキップ）
+        cache_path = self._cache_path()
+        if cache_path and cache_path.exists() and self._load_snapshot(cache_path):
+            logger.info("[GTFS] Restored %d stops / %d trips from snapshot", len(self.stops), len(self.stop_times))
+            return
 
         try:
             # stops.json
-            with open(self.gtfs_dir / "stops.json", encoding="utf-8") as f:
-                stops_data = json.load(f)
-                for stop in stops_data:
-                    self.stops[stop["stop_id"]] = {
-                        "lat": float(stop["stop_lat"]),
-                        "lng": float(stop["stop_lon"]),
-                        "name": stop["stop_name"]
-                    }
-            print(f"[GTFS] Loaded {len(self.stops)} stops")
+            stops_data = orjson.loads((self.gtfs_dir / "stops.json").read_bytes())
+            for stop in stops_data:
+                # IDは大量に重複するのでinternして1オブジェクトを共有する
+                self.stops[sys.intern(stop["stop_id"])] = {
+                    "lat": float(stop["stop_lat"]),
+                    "lng": float(stop["stop_lon"]),
+                    "name": stop["stop_name"]
+                }
+            logger.info("[GTFS] Loaded %d stops", len(self.stops))
         except Exception as e:
-            print(f"[GTFS] Failed to load stops.json: {e}")
+            logger.warning("[GTFS] Failed to load stops.json: %s", e)
 
         try:
             # routes.json
-            with open(self.gtfs_dir / "routes.json", encoding="utf-8") as f:
-                routes_data = json.load(f)
-                for route in routes_data:
-                    self.routes[route["route_id"]] = {
-                        "name": route.get("route_long_name", route.get("route_short_name", "")),
-                        "color": f"#{route['route_color']}" if "route_color" in route else "#4CAF50"
-                    }
-            print(f"[GTFS] Loaded {len(self.routes)} routes")
+            routes_data = orjson.loads((self.gtfs_dir / "routes.json").read_bytes())
+            for route in routes_data:
+                self.routes[sys.intern(route["route_id"])] = {
+                    "name": route.get("route_long_name", route.get("route_short_name", "")),
+                    "color": f"#{route['route_color']}" if "route_color" in route else "#4CAF50"
+                }
+            logger.info("[GTFS] Loaded %d routes", len(self.routes))
         except Exception as e:
-            print(f"[GTFS] Failed to load routes.json: {e}")
+            logger.warning("[GTFS] Failed to load routes.json: %s", e)
 
         try:
             # trips.json
-            with open(self.gtfs_dir / "trips.json", encoding="utf-8") as f:
-                trips_data = json.load(f)
-                for trip in trips_data:
-                    self.trips[trip["trip_id"]] = {
-                        "route_id": trip["route_id"],
-                        "headsign": trip.get("trip_headsign", "")
-                    }
-            print(f"[GTFS] Loaded {len(self.trips)} trips")
+            trips_data = orjson.loads((self.gtfs_dir / "trips.json").read_bytes())
+            for trip in trips_data:
+                self.trips[sys.intern(trip["trip_id"])] = {
+                    "route_id": sys.intern(trip["route_id"]),
+                    "headsign": trip.get("trip_headsign", "")
+                }
+            logger.info("[GTFS] Loaded %d trips", len(self.trips))
         except Exception as e:
-            print(f"[GTFS] Failed to load trips.json: {e}")
+            logger.warning("[GTFS] Failed to load trips.json: %s", e)
 
         try:
             # stop_times.json
-            print("[GTFS] Loading stop_times.json (this may take a while)...")
-            with open(self.gtfs_dir / "stop_times.json", encoding="utf-8") as f:
-                stop_times_data = json.load(f)
-                for st in stop_times_data:
-                    trip_id = st["trip_id"]
-                    if trip_id not in self.stop_times:
-                        self.stop_times[trip_id] = []
-
-                    # arrival_timeやdeparture_timeが空文字列の場合はスキップ
-                    arrival = st.get("arrival_time", "")
-                    departure = st.get("departure_time", "")
-
-                    self.stop_times[trip_id].append({
-                        "stop_id": st["stop_id"],
-                        "arrival_time": arrival if arrival else None,
-                        "departure_time": departure if departure else None,
-                        "stop_sequence": int(st["stop_sequence"])
-                    })
-
-            # stop_timesをsequenceでソート
-            for trip_id in self.stop_times:
-                self.stop_times[trip_id].sort(key=lambda x: x["stop_sequence"])
-
-            print(f"[GTFS] Loaded stop_times for {len(self.stop_times)} trips")
+            logger.info("[GTFS] Loading stop_times.json (this may take a while)...")
+            stop_times_data = orjson.loads((self.gtfs_dir / "stop_times.json").read_bytes())
+            raw = {}  # trip_id → [(sequence, stop_id, arrival_sec, departure_sec), ...]
+            for st in stop_times_data:
+                # 時刻はロード時に一度だけ秒へ変換（欠損・空文字列は-1）
+                arrival = st.get("arrival_time", "")
+                departure = st.get("departure_time", "")
+                raw.setdefault(sys.intern(st["trip_id"]), []).append((
+                    int(st["stop_sequence"]),
+                    sys.intern(st["stop_id"]),
+                    time_to_seconds(arrival) if arrival else -1,
+                    time_to_seconds(departure) if departure else -1,
+                ))
+            # パース結果の巨大リストを先に解放してからSoA変換（ピークRSS削減）
+            del stop_times_data
+
+            # sequenceでソートし、SoA（stop_idタプル + int32時刻配列）へ変換。
+            # あわせてマッチング用インデックスを構築:
+            # - trips_by_number: 列車番号から候補tripをO(1)で引く。
+            #   trip_idは「2桁路線 + 1桁系統 + 5文字列車番号」（例: 1101223T → 1223T）
+            #   なので先頭3文字を落とす。ODPT側はゼロ詰めなしの番号を使うことが
+            #   あるため、先頭0を除いた形（0554M → 554M）でも引けるようにする
+            # - idx: 停車駅の線形探索(.index)をO(1)のdict参照にする
+            for trip_id, rows in raw.items():
+                rows.sort()
+                stop_ids = tuple(r[1] for r in rows)
+                idx = {}
+                for i, sid in enumerate(stop_ids):
+                    idx.setdefault(sid, i)
+                self.stop_times[trip_id] = {
+                    "stop_ids": stop_ids,
+                    "arr": np.array([r[2] for r in rows], dtype=np.int32),
+                    "dep": np.array([r[3] for r in rows], dtype=np.int32),
+                    "idx": idx,
+                }
+                number = trip_id[3:] if len(trip_id) > 3 and trip_id[:3].isdigit() else trip_id
+                self.trips_by_number.setdefault(number, []).append(trip_id)
+                stripped = number.lstrip("0")
+                if stripped and stripped != number:
+                    self.trips_by_number.setdefault(stripped, []).append(trip_id)
+
+            logger.info("[GTFS] Loaded stop_times for %d trips", len(self.stop_times))
         except Exception as e:
-            print(f"[GTFS] Failed to load stop_times.json: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("[GTFS] Failed to load stop_times.json: %s", e)
+
+        # 次回起動を高速化するためスナップショットを保存
+        if cache_path and self.stop_times:
+            self._save_snapshot(cache_path)
 
 def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """2点間の距離をkmで計算"""
@@ -226,27 +350,56 @@ class StationMapper:
         self.create_mapping()
 
     def create_mapping(self, max_distance_km: float = 0.3):
-        """座標ベースで駅をマッピング（300m以内）"""
-        print("[Mapper] Creating station mapping...")
+        """座標ベースで駅をマッピング（300m以内）
 
-        for odpt_id, odpt_station in self.odpt_stations.items():
-            best_match = None
-            best_distance = float('inf')
+        GTFS駅を約1kmの地理タイルにバケツ分けし、各ODPT駅は周囲9タイルの
+        候補だけとNumPyのhaversineで比較する。全ペア比較のO(N·M)が
+        O(N·k)（kはタイルあたりの駅数）まで落ち、GTFS側が増えてもスケールする。
+        """
+        logger.info("[Mapper] Creating station mapping...")
 
-            for gtfs_id, gtfs_stop in self.gtfs_stops.items():
-                distance = haversine_distance(
-                    odpt_station["lat"], odpt_station["lon"],
-                    gtfs_stop["lat"], gtfs_stop["lng"]
-                )
+        if not self.odpt_stations or not self.gtfs_stops:
+            logger.info("[Mapper] Mapped 0 stations")
+            return
 
-                if distance < best_distance and distance < max_distance_km:
-                    best_distance = distance
-                    best_match = gtfs_id
+        gtfs_ids = list(self.gtfs_stops.keys())
+        gtfs_lat_deg = np.array([self.gtfs_stops[i]["lat"] for i in gtfs_ids], dtype=np.float64)
+        gtfs_lng_deg = np.array([self.gtfs_stops[i]["lng"] for i in gtfs_ids], dtype=np.float64)
+        gtfs_lat = np.radians(gtfs_lat_deg)
+        gtfs_lng = np.radians(gtfs_lng_deg)
 
-            if best_match:
-                self.odpt_to_gtfs[odpt_id] = best_match
+        # 0.01度（東京近辺で約1km）タイルへバケツ分け
+        grid: Dict[tuple, List[int]] = {}
+        for i, (la, ln) in enumerate(zip(gtfs_lat_deg.tolist(), gtfs_lng_deg.tolist())):
+            grid.setdefault((int(la * 100), int(ln * 100)), []).append(i)
 
-        print(f"[Mapper] Mapped {len(self.odpt_to_gtfs)} stations")
+        for odpt_id, odpt_station in self.odpt_stations.items():
+            la, ln = odpt_station["lat"], odpt_station["lon"]
+            cell_lat, cell_lng = int(la * 100), int(ln * 100)
+
+            # 周囲9タイルから候補を収集
+            candidates: List[int] = []
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    candidates.extend(grid.get((cell_lat + dy, cell_lng + dx), ()))
+            if not candidates:
+                continue
+
+            # 候補だけをベクトル化haversineで比較
+            idx = np.array(candidates, dtype=np.intp)
+            lat1 = math.radians(la)
+            dlat = gtfs_lat[idx] - lat1
+            dlng = gtfs_lng[idx] - math.radians(ln)
+            a = (np.sin(dlat / 2) ** 2 +
+                 math.cos(lat1) * np.cos(gtfs_lat[idx]) *
+                 np.sin(dlng / 2) ** 2)
+            dist = 2 * 6371 * np.arcsin(np.sqrt(a))
+
+            j = int(dist.argmin())
+            if dist[j] < max_distance_km:
+                self.odpt_to_gtfs[odpt_id] = gtfs_ids[candidates[j]]
+
+        logger.info("[Mapper] Mapped %d stations", len(self.odpt_to_gtfs))
 
     def get_gtfs_stop_id(self, odpt_station_id: str) -> Optional[str]:
         """ODPT駅ID → GTFS駅IDに変換"""
@@ -257,15 +410,13 @@ class TripMatcher:
     def __init__(self, gtfs_loader: GTFSLoader, station_mapper: StationMapper):
         self.gtfs_loader = gtfs_loader
         self.station_mapper = station_mapper
-        self.cache = {}  # rt_trip_id → static_trip_id のキャッシュ
+        # (rt_trip_id, サービス日) → static_trip_id のLRUキャッシュ。
+        # 日付が変わると別キーになるため前日のマッチを引きずらない
+        self.cache: "OrderedDict[tuple, str]" = OrderedDict()
 
-    def time_to_seconds(self, time_str: str) -> int:
-        """HH:MM:SS を秒に変換（24:00:00以降も対応）"""
-        if not time_str:
-            return 0
-        parts = time_str.split(":")
-        h, m, s = int(parts[0]), int(parts[1]), int(parts[2]) if len(parts) > 2 else 0
-        return h * 3600 + m * 60 + s
+        # rt_trip_id → (from_stop, to_stop, 区間タプル)。
+        # 同じ区間を走り続けている間はマッチングと区間解決を丸ごとスキップできる
+        self.segment_cache: Dict[str, tuple] = {}
 
     def extract_train_number(self, rt_trip_id: str) -> str:
         """JR-East.Chuo.554M → 554M"""
@@ -291,18 +442,18 @@ class TripMatcher:
             GTFS trip_id (例: "1610554M") or None
         """
 
-        # キャッシュチェック
-        if rt_trip_id in self.cache:
-            return self.cache[rt_trip_id]
+        # キャッシュチェック（midnight_epochはサービス日ごとに変わる）
+        key = (rt_trip_id, cache.midnight_epoch)
+        hit = self.cache.get(key)
+        if hit is not None:
+            self.cache.move_to_end(key)
+            return hit
 
         # 列車番号抽出
         train_number = self.extract_train_number(rt_trip_id)
 
-        # 候補抽出（列車番号を含むtrip）
-        candidates = [
-            trip_id for trip_id in self.gtfs_loader.stop_times.keys()
-            if train_number in trip_id
-        ]
+        # 候補抽出（事前構築した列車番号インデックスをO(1)で参照）
+        candidates = self.gtfs_loader.trips_by_number.get(train_number, ())
 
         if not candidates:
             return None
@@ -316,68 +467,51 @@ class TripMatcher:
         best_score = -float('inf')
 
         for candidate_id in candidates:
-            stop_times = self.gtfs_loader.stop_times[candidate_id]
-
-            if not stop_times:
+            entry = self.gtfs_loader.stop_times[candidate_id]
+            if not entry["stop_ids"]:
                 continue
 
-            # 最初の発車時刻
-            first_stop = stop_times[0]
-            first_time_str = first_stop.get("departure_time") or first_stop.get("arrival_time")
-            if not first_time_str:
+            # 最初の発車時刻（ロード時に秒変換済み。-1は欠損）
+            first_departure = entry["dep"][0] if entry["dep"][0] >= 0 else entry["arr"][0]
+            if first_departure < 0:
                 continue
 
-            first_departure = self.time_to_seconds(first_time_str)
-
             # 時刻の近さ（近いほど高スコア）
-            time_diff = abs(current_time_sec - first_departure)
+            time_diff = abs(current_time_sec - int(first_departure))
             score = -time_diff
 
-            # 駅マッチング
-            stop_ids = [st["stop_id"] for st in stop_times]
+            # 駅マッチング（事前構築のidxでO(1)参照）
+            stop_idx = entry["idx"]
 
-            idx_from = -1
-            idx_to = -1
+            idx_from = stop_idx.get(from_stop_gtfs, -1) if from_stop_gtfs else -1
+            idx_to = stop_idx.get(to_stop_gtfs, -1) if to_stop_gtfs else -1
 
-            if from_stop_gtfs:
-                try:
-                    idx_from = stop_ids.index(from_stop_gtfs)
-                    score += 10000  # from駅一致ボーナス
-                except ValueError:
-                    pass
-
-            if to_stop_gtfs:
-                try:
-                    idx_to = stop_ids.index(to_stop_gtfs)
-                    score += 10000  # to駅一致ボーナス
-                except ValueError:
-                    pass
+            if idx_from >= 0:
+                score += 10000  # from駅一致ボーナス
+            if idx_to >= 0:
+                score += 10000  # to駅一致ボーナス
 
             # 駅順序が正しいか
             if idx_from >= 0 and idx_to >= 0 and idx_from < idx_to:
                 score += 1000  # 順序正しいボーナス
 
                 # 現在時刻が区間内にあるか
-                from_stop = stop_times[idx_from]
-                to_stop = stop_times[idx_to]
-
-                dep_time_str = from_stop.get("departure_time")
-                arr_time_str = to_stop.get("arrival_time")
+                dep_time = int(entry["dep"][idx_from])
+                arr_time = int(entry["arr"][idx_to])
 
-                if dep_time_str and arr_time_str:
-                    dep_time = self.time_to_seconds(dep_time_str)
-                    arr_time = self.time_to_seconds(arr_time_str)
-
-                    if dep_time <= current_time_sec <= arr_time:
-                        score += 500  # 区間内ボーナス
+                if dep_time >= 0 and arr_time >= 0 and dep_time <= current_time_sec <= arr_time:
+                    score += 500  # 区間内ボーナス
 
             if score > best_score:
                 best_score = score
                 best_trip_id = candidate_id
 
         if best_trip_id:
-            self.cache[rt_trip_id] = best_trip_id
-            print(f"[Matcher] {rt_trip_id} → {best_trip_id} (score: {best_score})")
+            self.cache[key] = best_trip_id
+            # サイズ上限つき（古いサービス日のエントリから追い出される）
+            while len(self.cache) > 50_000:
+                self.cache.popitem(last=False)
+            logger.debug("[Matcher] %s → %s (score: %s)", rt_trip_id, best_trip_id, best_score)
 
         return best_trip_id
 
@@ -402,8 +536,45 @@ class TripMatcher:
             }
         """
 
-        stop_times = self.gtfs_loader.stop_times.get(static_trip_id)
-        if not stop_times:
+        seg = self.segment_endpoints(static_trip_id, from_stop_odpt, to_stop_odpt)
+        if not seg:
+            return None
+
+        dep_time, arr_time, from_lat, from_lng, to_lat, to_lng, from_stop_gtfs, to_stop_gtfs = seg
+
+        # 遅延を加算
+        dep_time += delay_sec
+        arr_time += delay_sec
+
+        # 進捗率計算
+        progress = (current_time_sec - dep_time) / (arr_time - dep_time)
+        progress = max(0.0, min(1.0, progress))  # 0~1にクランプ
+
+        # 線形補間
+        lat = from_lat + (to_lat - from_lat) * progress
+        lng = from_lng + (to_lng - from_lng) * progress
+
+        return {
+            "lat": lat,
+            "lng": lng,
+            "progress": progress,
+            "from_stop_gtfs": from_stop_gtfs,
+            "to_stop_gtfs": to_stop_gtfs
+        }
+
+    def segment_endpoints(
+        self,
+        static_trip_id: str,
+        from_stop_odpt: str,
+        to_stop_odpt: str
+    ) -> Optional[tuple]:
+        """from→to区間の(発車秒, 到着秒, from緯度, from経度, to緯度, to経度, fromGTFS駅, toGTFS駅)を返す
+
+        poll_loopが複数車両分をまとめてNumPyで補間できるよう、
+        区間の定数部分（時刻と両端座標）だけを取り出す。
+        """
+        entry = self.gtfs_loader.stop_times.get(static_trip_id)
+        if not entry:
             return None
 
         # ODPT → GTFS 変換
@@ -413,44 +584,25 @@ class TripMatcher:
         if not from_stop_gtfs or not to_stop_gtfs:
             return None
 
-        # 該当する区間を検索
-        idx_from = -1
-        idx_to = -1
-
-        for i, st in enumerate(stop_times):
-            if st["stop_id"] == from_stop_gtfs:
-                idx_from = i
-            if st["stop_id"] == to_stop_gtfs:
-                idx_to = i
+        # 該当する区間を検索（事前構築のidxでO(1)参照）
+        stop_idx = entry["idx"]
+        idx_from = stop_idx.get(from_stop_gtfs, -1)
+        idx_to = stop_idx.get(to_stop_gtfs, -1)
 
         if idx_from < 0 or idx_to < 0 or idx_from >= idx_to:
             return None
 
-        # 時刻取得
-        from_stop = stop_times[idx_from]
-        to_stop = stop_times[idx_to]
-
-        dep_time_str = from_stop.get("departure_time") or from_stop.get("arrival_time")
-        arr_time_str = to_stop.get("arrival_time") or to_stop.get("departure_time")
+        # 時刻取得（ロード時に秒変換済み。-1は欠損）
+        dep_time = int(entry["dep"][idx_from])
+        if dep_time < 0:
+            dep_time = int(entry["arr"][idx_from])
+        arr_time = int(entry["arr"][idx_to])
+        if arr_time < 0:
+            arr_time = int(entry["dep"][idx_to])
 
-        if not dep_time_str or not arr_time_str:
+        if dep_time < 0 or arr_time < 0 or arr_time <= dep_time:
             return None
 
-        dep_time = self.time_to_seconds(dep_time_str)
-        arr_time = self.time_to_seconds(arr_time_str)
-
-        # 遅延を加算
-        dep_time += delay_sec
-        arr_time += delay_sec
-
-        # 進捗率計算
-        duration = arr_time - dep_time
-        if duration <= 0:
-            return None
-
-        progress = (current_time_sec - dep_time) / duration
-        progress = max(0.0, min(1.0, progress))  # 0~1にクランプ
-
         # 駅座標取得
         from_pos = self.gtfs_loader.stops.get(from_stop_gtfs)
         to_pos = self.gtfs_loader.stops.get(to_stop_gtfs)
@@ -458,48 +610,105 @@ class TripMatcher:
         if not from_pos or not to_pos:
             return None
 
-        # 線形補間
-        lat = from_pos["lat"] + (to_pos["lat"] - from_pos["lat"]) * progress
-        lng = from_pos["lng"] + (to_pos["lng"] - from_pos["lng"]) * progress
-
-        return {
-            "lat": lat,
-            "lng": lng,
-            "progress": progress,
-            "from_stop_gtfs": from_stop_gtfs,
-            "to_stop_gtfs": to_stop_gtfs
-        }
+        return (
+            dep_time, arr_time,
+            from_pos["lat"], from_pos["lng"],
+            to_pos["lat"], to_pos["lng"],
+            from_stop_gtfs, to_stop_gtfs,
+        )
 
 # キャッシュ
 class DataCache:
     def __init__(self) -> None:
         self.seq = 0
-        self.vehicles_by_railway: Dict[str, List[Vehicle]] = {}
-        self.last_seen_by_trip: Dict[str, int] = {}
-        
-        # 駅キャッシュ: {station_id: {lat, lng, name}}
-        self.stations: Dict[str, Dict[str, Any]] = {}
-        
+        self.vehicles_by_railway: Dict[str, List[Dict[str, Any]]] = {}
+        # trip_id → 最終観測時刻。長期稼働で無限に増えないようLRUで上限を設ける
+        self.last_seen_by_trip: "OrderedDict[str, int]" = OrderedDict()
+        self.last_seen_max = 20_000
+
+        # poll_loopが新しいスナップショットを書き込んだことをSSEクライアントに通知
+        self.update_event = asyncio.Event()
+
+        # 事前構築済みSSEフレーム: {railway_key: b"event: snapshot\ndata: ...\n\n"}
+        self.frame_bytes_by_railway: Dict[str, bytes] = {}
+
+        # 差分フレーム: {railway_key: (seq, bytes)}。?delta=1のクライアント向けに
+        # 前tickから変化した車両と消えた車両だけを載せる
+        self.delta_frames_by_railway: Dict[str, tuple] = {}
+        self._prev_vehicles_by_railway: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+        # 駅座標キャッシュ（SoA）: (station_index, lat配列, lng配列) の3点セット。
+        # index[station_id]が配列の添字。読み手がワーカースレッドで動くため、
+        # 新旧が混ざらないようタプル1個をアトミックに差し替える
+        self.stations_soa: tuple = (
+            {},
+            np.empty(0, dtype=np.float64),
+            np.empty(0, dtype=np.float64),
+        )
+
         # 時刻表キャッシュ: {trip_id: {stops: [{stop_id, arrival, departure, sequence}]}}
         self.timetables: Dict[str, Dict[str, Any]] = {}
 
-    def snapshot(self, railway_id_norm: Optional[str]) -> Snapshot:
+        # 路線別ビュー: {railway_norm: {trip_id: entry}}（/api/timetablesのフィルタ用）
+        self.timetables_by_railway: Dict[str, Dict[str, Any]] = {}
+
+        # 時刻表ロード完了時に計算するETagベース値（/api/timetablesの304応答用）
+        self.timetables_etag: Optional[str] = None
+
+        # /api/timetables のシリアライズ済みボディ（railway_norm or "all" → bytes）。
+        # 時刻表の差し替え時に破棄される
+        self.timetables_body_cache: Dict[str, bytes] = {}
+
+        # 今日の00:00のUNIX秒。current_time_secを引き算だけで出すためのキャッシュ
+        self.midnight_epoch: int = today_midnight_epoch()
+
+    def build_frames(self) -> None:
+        """ポーリング1回ごとにSSEフレームを構築し、全クライアントで共有する"""
         self.seq += 1
         now = unix_ts()
-        vehicles: List[Vehicle]
+        for key, vehicles in self.vehicles_by_railway.items():
+            # TTL切れはpoll_loop側で除外済み
+            railway_id = None if key == "__ALL__" else key
+            payload = {"ts": now, "seq": self.seq, "railwayId": railway_id, "vehicles": vehicles}
+            # orjsonは常にUTF-8のbytesを返す（ensure_ascii=False相当）
+            self.frame_bytes_by_railway[key] = SSE_SNAPSHOT_PREFIX + orjson.dumps(payload) + SSE_TERM
+
+            # 差分フレームも構築（変化した車両=upd、消えた車両=del）。
+            # 直前seqから連続して受信しているクライアントだけが適用できる
+            prev = self._prev_vehicles_by_railway.get(key)
+            cur = {v["trip_id"]: v for v in vehicles}
+            if prev is not None:
+                upd = [v for trip_id, v in cur.items() if prev.get(trip_id) != v]
+                gone = [trip_id for trip_id in prev if trip_id not in cur]
+                delta_payload = {"ts": now, "seq": self.seq, "railwayId": railway_id, "upd": upd, "del": gone}
+                self.delta_frames_by_railway[key] = (self.seq, SSE_DELTA_PREFIX + orjson.dumps(delta_payload) + SSE_TERM)
+            self._prev_vehicles_by_railway[key] = cur
+
+    def snapshot(self, railway_id_norm: Optional[str]) -> Dict[str, Any]:
+        now = unix_ts()
+        vehicles: List[Dict[str, Any]]
         if railway_id_norm:
-            items = self.vehicles_by_railway.get(railway_id_norm, [])
-            vehicles = [v for v in items if v.timestamp is None or now - v.timestamp <= TTL_SEC]
+            vehicles = self.vehicles_by_railway.get(railway_id_norm, [])
         else:
-            all_items: List[Vehicle] = []
+            vehicles = []
             for arr in self.vehicles_by_railway.values():
-                all_items.extend(arr)
-            vehicles = [v for v in all_items if v.timestamp is None or now - v.timestamp <= TTL_SEC]
-        return Snapshot(ts=now, seq=self.seq, railwayId=railway_id_norm, vehicles=vehicles)
+                vehicles.extend(arr)
+        return {"ts": now, "seq": self.seq, "railwayId": railway_id_norm, "vehicles": vehicles}
 
 cache = DataCache()
-client = httpx.AsyncClient()
-app = FastAPI()
+# ODPT向け共有クライアント: keep-aliveプール + HTTP/2 + 共通タイムアウト
+client = httpx.AsyncClient(
+    base_url=ODPT_BASE,
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    params={"acl:consumerKey": ODPT_KEY},
+)
+# デフォルトのレスポンスもorjsonでシリアライズする
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# CPU処理（変換・マッチング・補間）をイベントループから逃がす専用プール
+poll_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="poll-cpu")
 
 # GTFS統合システムのグローバル変数
 gtfs_loader: Optional[GTFSLoader] = None
@@ -515,109 +724,101 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 位置補間関数
-def interpolate_position(
-    from_station: Dict[str, Any],
-    to_station: Dict[str, Any],
-    timetable_stops: List[Dict[str, Any]],
-    current_time_sec: int,
-    delay_sec: int
-) -> Optional[Dict[str, float]]:
-    """駅間の位置を時刻表ベースで補間"""
-    
-    # from/to の駅IDを探す
-    from_idx = None
-    to_idx = None
-    
-    for i, stop in enumerate(timetable_stops):
-        if stop["stop_id"] == from_station.get("id"):
-            from_idx = i
-        if stop["stop_id"] == to_station.get("id"):
-            to_idx = i
-    
+# 大きいJSON（/api/timetables等）をgzip圧縮する。text/event-streamは
+# デフォルトで除外されるのでSSEには影響しない
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# 位置補間
+def _segment_times(
+    timetable: Dict[str, Any],
+    from_station_id: Optional[str],
+    to_station_id: Optional[str]
+) -> Optional[tuple]:
+    """時刻表からfrom→to区間の(発車秒, 到着秒)を取り出す"""
+    # 登録時に構築した stop_id → index でO(1)検索
+    stop_index = timetable["index"]
+    from_idx = stop_index.get(from_station_id)
+    to_idx = stop_index.get(to_station_id)
+
     if from_idx is None or to_idx is None or from_idx >= to_idx:
         return None
-    
-    from_stop = timetable_stops[from_idx]
-    to_stop = timetable_stops[to_idx]
-    
-    # 発車時刻と到着時刻
-    dep_time = time_to_seconds(from_stop.get("departure") or from_stop.get("arrival", "00:00:00"))
-    arr_time = time_to_seconds(to_stop.get("arrival", "00:00:00"))
-    
+
+    # 発車時刻と到着時刻（登録時に秒へ変換してentryの並行配列に格納済み）
+    dep_time = timetable["dep"][from_idx] or timetable["arr"][from_idx]
+    arr_time = timetable["arr"][to_idx]
+
     if arr_time <= dep_time:
         return None
-    
-    # 遅延を反映
-    adjusted_current = current_time_sec
-    adjusted_dep = dep_time + delay_sec
-    adjusted_arr = arr_time + delay_sec
-    
-    # 進捗率計算
-    if adjusted_current < adjusted_dep:
-        progress = 0.0
-    elif adjusted_current > adjusted_arr:
-        progress = 1.0
-    else:
-        progress = (adjusted_current - adjusted_dep) / (adjusted_arr - adjusted_dep)
-    
-    # 座標補間
-    from_lat = from_station.get("lat")
-    from_lng = from_station.get("lng")
-    to_lat = to_station.get("lat")
-    to_lng = to_station.get("lng")
-    
-    if None in [from_lat, from_lng, to_lat, to_lng]:
-        return None
-    
-    lat = from_lat + (to_lat - from_lat) * progress
-    lng = from_lng + (to_lng - from_lng) * progress
-    
-    return {"lat": lat, "lng": lng, "progress": progress}
+
+    return dep_time, arr_time
 
 # データ変換
-def map_odpt_trains_to_vehicles(items: List[Dict[str, Any]]) -> List[Vehicle]:
-    out: List[Vehicle] = []
-    now = unix_ts()
-    
-    # 現在の時刻（秒）- 今日の00:00からの経過秒数
-    current_dt = datetime.now()
-    current_time_sec = current_dt.hour * 3600 + current_dt.minute * 60 + current_dt.second
-    
-    for idx, it in enumerate(items):
+def map_odpt_trains_to_vehicles(
+    items: List[Dict[str, Any]],
+    now: int,
+    current_time_sec: int
+) -> List[Dict[str, Any]]:
+    """now/current_time_secは呼び出し側で1tickにつき1回だけ取得して渡す"""
+    out: List[Dict[str, Any]] = []
+    out_append = out.append
+
+    # 属性・メソッド解決をループ外へ巻き上げる（毎車両×毎tick分の削減）。
+    # 駅SoAはタプルごと1回で取り出す（定期リフレッシュと並行しても新旧が混ざらない）
+    station_index, station_lat, station_lng = cache.stations_soa
+    station_index_get = station_index.get
+    timetables_get = cache.timetables.get
+
+    # ISOタイムスタンプのパース結果キャッシュ（1回の呼び出し内のみ有効）
+    ts_cache: Dict[str, int] = {}
+
+    # 駅間走行中の列車はここに積んでループ後にNumPyで一括補間する
+    batch_rows: List[int] = []
+    batch_dep: List[int] = []
+    batch_arr: List[int] = []
+    batch_delay: List[int] = []
+    batch_from: List[int] = []  # station_lat/lng配列の添字
+    batch_to: List[int] = []
+
+    for it in items:
+        it_get = it.get
         # odpt:train でtrip_idを取得（最優先）
-        trip_id_raw = it.get("odpt:train") or it.get("owl:sameAs") or ""
+        trip_id_raw = it_get("odpt:train") or it_get("owl:sameAs") or ""
         if not trip_id_raw:
             continue
         
         trip_id = normalize_trip_id(str(trip_id_raw))
         
         # 駅情報
-        from_station_id = it.get("odpt:fromStation")
-        to_station_id = it.get("odpt:toStation")
+        from_station_id = it_get("odpt:fromStation")
+        to_station_id = it_get("odpt:toStation")
         
         # 遅延（秒）
-        delay = it.get("odpt:delay", 0)
+        delay = it_get("odpt:delay", 0)
         
-        # タイムスタンプ
-        ts_iso = it.get("dct:valid") or it.get("dc:date")
+        # タイムスタンプ（同一レスポンス内でdct:validは重複するためパース結果をメモ化）
+        ts_iso = it_get("dct:valid") or it_get("dc:date")
         ts_epoch = now
         if ts_iso:
-            try:
-                ts_iso_clean = ts_iso.replace("Z", "+00:00")
-                dt = datetime.fromisoformat(ts_iso_clean)
-                ts_epoch = int(dt.timestamp())
-            except Exception:
-                pass
-        
+            cached_ts = ts_cache.get(ts_iso)
+            if cached_ts is not None:
+                ts_epoch = cached_ts
+            else:
+                try:
+                    ts_iso_clean = ts_iso.replace("Z", "+00:00")
+                    dt = datetime.fromisoformat(ts_iso_clean)
+                    ts_epoch = int(dt.timestamp())
+                except Exception:
+                    pass
+                ts_cache[ts_iso] = ts_epoch
+
         # 状態判定
         if to_station_id is None:
             # 駅に停車中
             status = "STOPPED_AT"
-            station = cache.stations.get(from_station_id)
-            if station:
-                lat = station["lat"]
-                lng = station["lng"]
+            s_idx = station_index_get(from_station_id)
+            if s_idx is not None:
+                lat = station_lat[s_idx].item()
+                lng = station_lng[s_idx].item()
                 progress = 0.0
             else:
                 lat = None
@@ -626,67 +827,291 @@ def map_odpt_trains_to_vehicles(items: List[Dict[str, Any]]) -> List[Vehicle]:
         else:
             # 駅間移動中
             status = "IN_TRANSIT_TO"
-            
-            # 時刻表から位置を補間
-            timetable = cache.timetables.get(trip_id_raw) or cache.timetables.get(trip_id)
-            from_station = cache.stations.get(from_station_id)
-            to_station = cache.stations.get(to_station_id)
-            
-            if timetable and from_station and to_station:
-                pos = interpolate_position(
-                    from_station,
-                    to_station,
-                    timetable["stops"],
-                    current_time_sec,
-                    delay
-                )
-                if pos:
-                    lat = pos["lat"]
-                    lng = pos["lng"]
-                    progress = pos["progress"]
-                else:
-                    # フォールバック: 中間地点
-                    lat = (from_station["lat"] + to_station["lat"]) / 2
-                    lng = (from_station["lng"] + to_station["lng"]) / 2
-                    progress = 0.5
+
+            # 時刻表から区間の時刻を取得（座標計算はバッチで実施）
+            timetable = timetables_get(trip_id_raw) or timetables_get(trip_id)
+            from_idx = station_index_get(from_station_id)
+            to_idx = station_index_get(to_station_id)
+
+            seg = None
+            if timetable and from_idx is not None and to_idx is not None:
+                seg = _segment_times(timetable, from_station_id, to_station_id)
+
+            if seg:
+                batch_rows.append(len(out))
+                batch_dep.append(seg[0])
+                batch_arr.append(seg[1])
+                batch_delay.append(delay)
+                batch_from.append(from_idx)
+                batch_to.append(to_idx)
+                lat = None
+                lng = None
+                progress = 0.0
+            elif from_idx is not None and to_idx is not None:
+                # フォールバック: 中間地点
+                lat = ((station_lat[from_idx] + station_lat[to_idx]) / 2).item()
+                lng = ((station_lng[from_idx] + station_lng[to_idx]) / 2).item()
+                progress = 0.5
             else:
-                # 駅座標だけある場合は中間地点
-                if from_station and to_station:
-                    lat = (from_station["lat"] + to_station["lat"]) / 2
-                    lng = (from_station["lng"] + to_station["lng"]) / 2
-                    progress = 0.5
-                else:
-                    lat = None
-                    lng = None
-                    progress = 0.0
-        
-        out.append(
-            Vehicle(
-                trip_id=trip_id,
-                lat=lat,
-                lng=lng,
-                status=status,
-                from_stop_id=from_station_id,
-                to_stop_id=to_station_id,
-                timestamp=ts_epoch,
-                progress=progress
-            )
-        )
-    
+                lat = None
+                lng = None
+                progress = 0.0
+
+        out_append({
+            "trip_id": trip_id,
+            "lat": lat,
+            "lng": lng,
+            "status": status,
+            "bearing": None,
+            "speed_kph": None,
+            "from_stop_id": from_station_id,
+            "to_stop_id": to_station_id,
+            "timestamp": ts_epoch,
+            "progress": progress,
+            "interpolated": None,
+        })
+
+    # 駅間走行中の列車をまとめて補間（列車ごとのPython演算を1回のNumPy演算に）
+    if batch_rows:
+        dep = np.asarray(batch_dep, dtype=np.float64)
+        arr = np.asarray(batch_arr, dtype=np.float64)
+        delay_arr = np.asarray(batch_delay, dtype=np.float64)
+        from_i = np.asarray(batch_from, dtype=np.intp)
+        to_i = np.asarray(batch_to, dtype=np.intp)
+
+        # SoA配列からfancy indexingで座標をまとめて取得
+        from_lat = station_lat[from_i]
+        from_lng = station_lng[from_i]
+        to_lat = station_lat[to_i]
+        to_lng = station_lng[to_i]
+
+        progress_arr = np.clip((current_time_sec - (dep + delay_arr)) / (arr - dep), 0.0, 1.0)
+        lat_arr = from_lat + (to_lat - from_lat) * progress_arr
+        lng_arr = from_lng + (to_lng - from_lng) * progress_arr
+
+        for row, v_lat, v_lng, v_progress in zip(batch_rows, lat_arr.tolist(), lng_arr.tolist(), progress_arr.tolist()):
+            v = out[row]
+            v["lat"] = v_lat
+            v["lng"] = v_lng
+            v["progress"] = v_progress
+
     return out
 
+def process_railway_trains(
+    odpt_trains: List[Dict[str, Any]],
+    now: int,
+    current_time_sec: int
+) -> List[Dict[str, Any]]:
+    """1路線分のODPT列車をVehicle dictへ変換・補間・フィルタする（純CPU処理）
+
+    poll_loopからワーカースレッドで実行される。ネットワークや
+    cacheへの書き込みは行わず、配信可能な車両リストだけを返す。
+    """
+    v_merged = map_odpt_trains_to_vehicles(odpt_trains, now, current_time_sec)
+
+    # GTFS補間を実行（既存の時刻表ベース補間の後）
+    if trip_matcher:
+        # 区間情報（時刻・両端座標）だけ車両ごとに解決し、
+        # 進捗率と線形補間はNumPyで全車両分まとめて計算する
+        pending: List[Dict[str, Any]] = []
+        seg_rows: List[tuple] = []
+
+        for vehicle in v_merged:
+            # 既に座標がある場合はスキップ（既存の補間が成功している）
+            if vehicle["lat"] is not None and vehicle["lng"] is not None:
+                continue
+
+            # GTFS-RTに座標がない、かつfrom/to駅情報がある場合、GTFS静的データで補間
+            from_stop = vehicle["from_stop_id"]
+            to_stop = vehicle["to_stop_id"]
+            if from_stop and to_stop:
+                try:
+                    # 前tickと同じ区間ならマッチング・区間解決をスキップ
+                    cached = trip_matcher.segment_cache.get(vehicle["trip_id"])
+                    if cached is not None and cached[0] == from_stop and cached[1] == to_stop:
+                        seg = cached[2]
+                    else:
+                        seg = None
+                        # ベストマッチ検索
+                        static_trip_id = trip_matcher.find_best_match(
+                            vehicle["trip_id"],
+                            current_time_sec,
+                            from_stop,
+                            to_stop
+                        )
+                        if static_trip_id:
+                            seg = trip_matcher.segment_endpoints(static_trip_id, from_stop, to_stop)
+                        if seg:
+                            if len(trip_matcher.segment_cache) > 20_000:
+                                trip_matcher.segment_cache.clear()
+                            trip_matcher.segment_cache[vehicle["trip_id"]] = (from_stop, to_stop, seg)
+
+                    if seg:
+                        pending.append(vehicle)
+                        seg_rows.append(seg[:6])
+                except Exception:
+                    # 個別のエラーは無視して続行
+                    pass
+
+        if seg_rows:
+            dep, arr, f_lat, f_lng, t_lat, t_lng = (
+                np.array(col, dtype=np.float64) for col in zip(*seg_rows)
+            )
+            progress = np.clip((current_time_sec - dep) / (arr - dep), 0.0, 1.0)
+            lat = f_lat + (t_lat - f_lat) * progress
+            lng = f_lng + (t_lng - f_lng) * progress
+
+            for vehicle, la, ln, pr in zip(pending, lat.tolist(), lng.tolist(), progress.tolist()):
+                vehicle["lat"] = la
+                vehicle["lng"] = ln
+                vehicle["progress"] = pr
+                vehicle["interpolated"] = True
+
+            logger.debug("[poll_loop] GTFS interpolated %d vehicles", len(pending))
+
+    if v_merged:
+        with_pos = sum(1 for v in v_merged if v["lat"] is not None)
+        logger.debug("[poll_loop] %d/%d vehicles have positions", with_pos, len(v_merged))
+
+    # TTL切れと、座標が得られなかった走行中列車をここで除外
+    # （座標なしの列車は描画できず配信コストだけかかる。停車中は駅IDで描けるため残す）
+    return [
+        v for v in v_merged
+        if (v["lat"] is not None or v["status"] == "STOPPED_AT")
+        and (v["timestamp"] is None or now - v["timestamp"] <= TTL_SEC)
+    ]
+
+# 静的データロード
+async def load_stations() -> Dict[str, Dict[str, Any]]:
+    """ODPT駅情報を取得してSoAキャッシュへアトミックに差し替える"""
+    logger.info("[Static] Loading ODPT station data...")
+    odpt_stations: Dict[str, Dict[str, Any]] = {}
+    stations = await fetch_odpt_stations(client, None)
+    station_ids: List[str] = []
+    station_lats: List[float] = []
+    station_lngs: List[float] = []
+    for station in stations:
+        station_id = station.get("owl:sameAs")
+        lat = station.get("geo:lat")
+        lng = station.get("geo:long") or station.get("geo:lon")
+        name = station.get("dc:title") or station.get("odpt:stationTitle", {}).get("ja", "")
+        if station_id and lat and lng:
+            station_ids.append(station_id)
+            station_lats.append(float(lat))
+            station_lngs.append(float(lng))
+            odpt_stations[station_id] = {"lat": lat, "lon": lng, "name": name}
+
+    # SoA形式で保持（補間時はfancy indexingでまとめて引く）。
+    # index+配列をタプル1個の代入で差し替える: 読み手はワーカースレッドで
+    # 並行して動くので、3フィールドを個別に代入すると新旧が混在しうる
+    station_index = {sid: i for i, sid in enumerate(station_ids)}
+    cache.stations_soa = (
+        station_index,
+        np.asarray(station_lats, dtype=np.float64),
+        np.asarray(station_lngs, dtype=np.float64),
+    )
+    logger.info("[Static] Loaded %d ODPT stations", len(station_index))
+    return odpt_stations
+
+async def load_timetables() -> None:
+    """対象路線の時刻表を取得してキャッシュへアトミックに差し替える"""
+    # 路線ごとに逐次awaitするとRTT×路線数かかるため並列で取得
+    logger.info("[Static] Loading timetables for %d railways...", len(TARGET_RAILWAYS))
+    results = await asyncio.gather(
+        *(fetch_odpt_timetables(client, rid, "Weekday") for rid in TARGET_RAILWAYS),
+        return_exceptions=True,
+    )
+
+    new_timetables: Dict[str, Dict[str, Any]] = {}
+    new_by_railway: Dict[str, Dict[str, Any]] = {}
+
+    for railway_id, timetables in zip(TARGET_RAILWAYS, results):
+        if isinstance(timetables, BaseException):
+            logger.warning("[Static] Failed to load timetables for %s: %s", railway_id, timetables)
+            continue
+        try:
+            railway_bucket = new_by_railway.setdefault(normalize_railway_id(railway_id), {})
+            for tt in timetables:
+                trip_id_raw = tt.get("odpt:train")
+                if not trip_id_raw:
+                    continue
+
+                stops = []
+                arr_secs: List[int] = []
+                dep_secs: List[int] = []
+                for i, obj in enumerate(tt.get("odpt:trainTimetableObject", [])):
+                    # デバッグ: 最初の1件だけキーを出力
+                    if i == 0 and logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("First timetable object keys: %s", list(obj.keys()))
+                        logger.debug("Sample object: %s", obj)
+
+                    arrival = obj.get("odpt:arrivalTime")
+                    departure = obj.get("odpt:departureTime")
+                    stops.append({
+                        "stop_id": obj.get("odpt:station"),
+                        "arrival": arrival,
+                        "departure": departure,
+                        "sequence": i + 1
+                    })
+                    # 毎tick文字列をパースしないよう秒もここで計算しておく。
+                    # stopsは/api/timetablesにそのまま載るので、導出値は
+                    # GTFSLoader同様entry側の並行配列に置き配信形式を汚さない
+                    arr_secs.append(time_to_seconds(arrival or ""))
+                    dep_secs.append(time_to_seconds(departure or ""))
+
+                entry = {
+                    "stops": stops,
+                    "arr": arr_secs,
+                    "dep": dep_secs,
+                    # stop_id → index（_segment_timesのO(1)検索用）
+                    "index": {s["stop_id"]: i for i, s in enumerate(stops) if s["stop_id"]},
+                }
+                new_timetables[trip_id_raw] = entry
+                railway_bucket[trip_id_raw] = entry
+                # 正規化版でも登録
+                trip_id_norm = normalize_trip_id(trip_id_raw)
+                new_timetables[trip_id_norm] = entry
+                railway_bucket[trip_id_norm] = entry
+
+            logger.info("[Static] Loaded %d timetables for %s", len(timetables), railway_id)
+        except Exception as e:
+            logger.warning("[Static] Failed to load timetables for %s: %s", railway_id, e)
+
+    # 完成した辞書ごと差し替え（読み取り側が途中状態を見ない）
+    cache.timetables = new_timetables
+    cache.timetables_by_railway = new_by_railway
+    cache.timetables_body_cache = {}
+
+    # ロード完了時点の内容でETagを確定（以後/api/timetablesは304を返せる）。
+    # キー集合だけでなく停車時刻そのものをハッシュする: trip構成が同じまま
+    # 時刻だけ変わるダイヤ修正でもETagが変わり、クライアントが再取得できる
+    h = hashlib.md5()
+    for trip_id in sorted(new_timetables):
+        h.update(trip_id.encode())
+        h.update(orjson.dumps(new_timetables[trip_id]["stops"]))
+    cache.timetables_etag = h.hexdigest()
+
+async def refresh_static_data() -> None:
+    """駅・時刻表を定期的に再取得する（1回きりのロードだとダイヤ改正に追従できない）"""
+    while True:
+        await asyncio.sleep(STATIC_REFRESH_SEC)
+        try:
+            await load_stations()
+            await load_timetables()
+            logger.info("[Static] Periodic refresh complete")
+        except Exception as e:
+            logger.warning("[Static] Periodic refresh failed: %s", e)
+
 # ポーリングループ
 async def poll_loop() -> None:
     global gtfs_loader, station_mapper, trip_matcher
 
     await asyncio.sleep(0.2)
-    print("=" * 60)
-    print("[poll_loop] STARTED!")
-    print("=" * 60)
+    logger.info("[poll_loop] STARTED!")
 
     # GTFSシステムの初期化
     try:
-        print("[Startup] Initializing GTFS system...")
+        logger.info("[Startup] Initializing GTFS system...")
 
         # GTFSローダー（複数のパスを試す）
         possible_paths = ["./train_json", "../train_json", "/home/user/newNowTrain/train_json"]
@@ -695,28 +1120,17 @@ async def poll_loop() -> None:
             from pathlib import Path
             if Path(path).exists():
                 gtfs_path = path
-                print(f"[Startup] Found GTFS data at: {path}")
+                logger.info("[Startup] Found GTFS data at: %s", path)
                 break
 
         if not gtfs_path:
-            print("[Startup] WARNING: train_json directory not found!")
+            logger.warning("[Startup] train_json directory not found!")
             gtfs_loader = None
         else:
             gtfs_loader = GTFSLoader(gtfs_path)
 
         # ODPT駅情報取得
-        print("[Startup] Loading ODPT station data...")
-        odpt_stations = {}
-        stations = await fetch_odpt_stations(client, None)
-        for station in stations:
-            station_id = station.get("owl:sameAs")
-            lat = station.get("geo:lat")
-            lng = station.get("geo:long") or station.get("geo:lon")
-            name = station.get("dc:title") or station.get("odpt:stationTitle", {}).get("ja", "")
-            if station_id and lat and lng:
-                cache.stations[station_id] = {"id": station_id, "lat": lat, "lng": lng, "name": name}
-                odpt_stations[station_id] = {"lat": lat, "lon": lng, "name": name}
-        print(f"[Startup] Loaded {len(cache.stations)} ODPT stations")
+        odpt_stations = await load_stations()
 
         # 駅マッピング
         if gtfs_loader:
@@ -725,228 +1139,249 @@ async def poll_loop() -> None:
             # trip マッチャー
             trip_matcher = TripMatcher(gtfs_loader, station_mapper)
 
-            print("[Startup] GTFS system ready!")
+            logger.info("[Startup] GTFS system ready!")
         else:
-            print("[Startup] GTFS system not initialized (train_json not found)")
+            logger.info("[Startup] GTFS system not initialized (train_json not found)")
     except Exception as e:
-        print(f"[Startup] Failed to initialize GTFS system: {e}")
-        import traceback
-        traceback.print_exc()
-    
-    # 起動時に時刻表を取得（JR東日本の主要路線）
-    target_railways = [
-        "odpt.Railway:JR-East.ChuoSobuLocal",
-        "odpt.Railway:JR-East.ChuoRapid",
-        "odpt.Railway:JR-East.Yamanote",
-    ]
-    
-    for railway_id in target_railways:
-        try:
-            print(f"[poll_loop] Loading timetables for {railway_id}...")
-            timetables = await fetch_odpt_timetables(client, railway_id, "Weekday")
-            
-            for tt in timetables:
-                trip_id_raw = tt.get("odpt:train")
-                if not trip_id_raw:
-                    continue
-                
-                stops = []
-                for i, obj in enumerate(tt.get("odpt:trainTimetableObject", [])):
-                    # デバッグ: 最初の1件だけキーを出力
-                    if i == 0:
-                        print(f"[DEBUG] First timetable object keys: {list(obj.keys())}")
-                        print(f"[DEBUG] Sample object: {obj}")
-                    
-                    stops.append({
-                        "stop_id": obj.get("odpt:station"),
-                        "arrival": obj.get("odpt:arrivalTime"),
-                        "departure": obj.get("odpt:departureTime"),
-                        "sequence": i + 1
-                    })
-                
-                cache.timetables[trip_id_raw] = {"stops": stops}
-                # 正規化版でも登録
-                trip_id_norm = normalize_trip_id(trip_id_raw)
-                cache.timetables[trip_id_norm] = {"stops": stops}
-            
-            print(f"[poll_loop] Loaded {len(timetables)} timetables for {railway_id}")
-        except Exception as e:
-            print(f"[poll_loop] Failed to load timetables for {railway_id}: {e}")
-    
+        logger.exception("[Startup] Failed to initialize GTFS system: %s", e)
+
+    # 起動時に時刻表を取得
+    await load_timetables()
+
     # ポーリングループ
     while True:
         try:
-            print("\n" + "=" * 60)
-            print(f"[poll_loop] Polling at {datetime.now()}")
-            print("=" * 60)
-            
-            railways = [None]  # 全路線取得
-            for railway_filter in railways:
-                odpt_trains = await fetch_odpt_trains(client, railway_filter)
-                print(f"[poll_loop] ODPT returned: {len(odpt_trains)} trains")
-
-                v_merged = map_odpt_trains_to_vehicles(odpt_trains)
-                print(f"[poll_loop] Converted to {len(v_merged)} vehicles")
-
-                # GTFS補間を実行（既存の時刻表ベース補間の後）
-                if trip_matcher:
-                    interpolated_count = 0
-                    current_dt = datetime.now()
-                    current_time_sec = current_dt.hour * 3600 + current_dt.minute * 60 + current_dt.second
-
-                    for vehicle in v_merged:
-                        # 既に座標がある場合はスキップ（既存の補間が成功している）
-                        if vehicle.lat is not None and vehicle.lng is not None:
-                            continue
-
-                        # GTFS-RTに座標がない、かつfrom/to駅情報がある場合、GTFS静的データで補間
-                        if vehicle.from_stop_id and vehicle.to_stop_id:
-                            try:
-                                # ベストマッチ検索
-                                static_trip_id = trip_matcher.find_best_match(
-                                    vehicle.trip_id,
-                                    current_time_sec,
-                                    vehicle.from_stop_id,
-                                    vehicle.to_stop_id
-                                )
-
-                                if static_trip_id:
-                                    # 位置補間
-                                    position = trip_matcher.interpolate_position(
-                                        static_trip_id,
-                                        current_time_sec,
-                                        vehicle.from_stop_id,
-                                        vehicle.to_stop_id,
-                                        0  # delay_sec（将来的にはvehicle.delayから取得）
-                                    )
-
-                                    if position:
-                                        vehicle.lat = position["lat"]
-                                        vehicle.lng = position["lng"]
-                                        vehicle.progress = position["progress"]
-                                        vehicle.interpolated = True
-                                        interpolated_count += 1
-                            except Exception as e:
-                                # 個別のエラーはログだけ出して続行
-                                pass
-
-                    if interpolated_count > 0:
-                        print(f"[poll_loop] GTFS interpolated {interpolated_count} vehicles")
-
-                if v_merged:
-                    with_pos = sum(1 for v in v_merged if v.lat is not None)
-                    print(f"[poll_loop] {with_pos}/{len(v_merged)} vehicles have positions")
-
-                key = normalize_railway_id(railway_filter) if railway_filter else "__ALL__"
+            logger.debug("[poll_loop] Polling tick")
+
+            # 時刻はtickごとに1回だけ取得して使い回す
+            now = unix_ts()
+
+            # 日付が変わったら深夜0時のエポックを更新
+            if now - cache.midnight_epoch >= 86400:
+                cache.midnight_epoch = today_midnight_epoch()
+            current_time_sec = now - cache.midnight_epoch
+
+            # 対象路線を並列で取得（全国一括クエリより転送・パースが小さく並列化できる）
+            results = await asyncio.gather(
+                *(fetch_odpt_trains(client, rid) for rid in TARGET_RAILWAYS),
+                return_exceptions=True,
+            )
+
+            all_vehicles: List[Dict[str, Any]] = []
+            loop = asyncio.get_running_loop()
+            for railway_filter, odpt_trains in zip(TARGET_RAILWAYS, results):
+                if isinstance(odpt_trains, BaseException):
+                    logger.warning("[poll_loop] Failed to fetch trains for %s: %s", railway_filter, odpt_trains)
+                    # 取得失敗時も前回分を無期限に再配信しない: TTLを超えた車両を
+                    # 落とし、残った分は__ALL__にも載せて路線別ストリームと揃える
+                    key = normalize_railway_id(railway_filter)
+                    stale = cache.vehicles_by_railway.get(key)
+                    if stale:
+                        last_seen = cache.last_seen_by_trip
+                        kept = [
+                            v for v in stale
+                            if now - (v["timestamp"] or last_seen.get(v["trip_id"], 0)) <= TTL_SEC
+                        ]
+                        cache.vehicles_by_railway[key] = kept
+                        all_vehicles.extend(kept)
+                    continue
+                logger.debug("[poll_loop] ODPT returned: %d trains for %s", len(odpt_trains), railway_filter)
+
+                # CPU処理（変換・マッチング・補間）はワーカースレッドへ逃がし、
+                # その間もイベントループがSSEや/api/*を捌けるようにする
+                v_merged = await loop.run_in_executor(
+                    poll_executor, process_railway_trains, odpt_trains, now, current_time_sec
+                )
+
+                key = normalize_railway_id(railway_filter)
                 cache.vehicles_by_railway[key] = v_merged
+                all_vehicles.extend(v_merged)
 
-                now = unix_ts()
                 for v in v_merged:
-                    cache.last_seen_by_trip[v.trip_id] = now
-                    
+                    trip_id = v["trip_id"]
+                    cache.last_seen_by_trip[trip_id] = now
+                    cache.last_seen_by_trip.move_to_end(trip_id)
+                while len(cache.last_seen_by_trip) > cache.last_seen_max:
+                    cache.last_seen_by_trip.popitem(last=False)
+
+            # 全路線まとめたスナップショットも維持（railwayId未指定のクライアント用）
+            cache.vehicles_by_railway["__ALL__"] = all_vehicles
+
+            # SSEフレームを1回だけ構築してから待機中のクライアントを起こす
+            cache.build_frames()
+            cache.update_event.set()
+            cache.update_event.clear()
+
         except Exception as e:
-            print(f"[poll_loop] ERROR: {type(e).__name__}: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("[poll_loop] ERROR: %s: %s", type(e).__name__, e)
         finally:
             await asyncio.sleep(POLL_INTERVAL_SEC)
 
 @app.on_event("startup")
 async def on_startup():
     asyncio.create_task(poll_loop())
+    asyncio.create_task(refresh_static_data())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await client.aclose()
 
 @app.get("/health")
 async def health():
-    return {"ok": True, "time": unix_ts(), "stations": len(cache.stations), "timetables": len(cache.timetables)}
+    return {"ok": True, "time": unix_ts(), "stations": len(cache.stations_soa[0]), "timetables": len(cache.timetables)}
 
 @app.get("/api/stations")
-async def api_stations(railwayId: Optional[str] = None):
+async def api_stations(request: Request, railwayId: Optional[str] = None):
     """駅リスト取得"""
     try:
         items = await fetch_odpt_stations(client, railwayId)
-        out = []
-        for it in items:
-            out.append({
-                "id": it.get("owl:sameAs"),
-                "title": it.get("odpt:stationTitle", {}).get("ja") or it.get("dc:title"),
-                "railwayId": normalize_railway_id(it.get("odpt:railway", "")),
-                "lat": it.get("geo:lat"),
-                "lng": it.get("geo:long") or it.get("geo:lon"),
-            })
-        return JSONResponse(out)
+        # 逐次appendせず内包表記で一括構築（ローカル束縛でルックアップも削減）
+        _nr = normalize_railway_id
+        out = [{
+            "id": it.get("owl:sameAs"),
+            "title": (it.get("odpt:stationTitle") or {}).get("ja") or it.get("dc:title"),
+            "railwayId": _nr(it.get("odpt:railway", "")),
+            "lat": it.get("geo:lat"),
+            "lng": it.get("geo:long") or it.get("geo:lon"),
+        } for it in items]
+
+        # 駅データはほぼ変化しないのでETag一致なら本文を送らない
+        body = orjson.dumps(out)
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304)
+        return Response(
+            content=body,
+            media_type="application/json",
+            headers={"ETag": etag, "Cache-Control": "public, max-age=300"},
+        )
     except Exception as e:
-        return JSONResponse({"error": str(e)}, status_code=500)
+        return ORJSONResponse({"error": str(e)}, status_code=500)
     
 @app.get("/api/timetables")
-async def get_timetables_api(railwayId: Optional[str] = None) -> Dict[str, Any]:
+async def get_timetables_api(request: Request, railwayId: Optional[str] = None):
     """
     時刻表データをGTFS形式で返す
     返却形式: { trip_id: { stops: [{stop_id, arrival, departure, sequence}] } }
     """
-    result = {}
-    
-    for trip_id, timetable in cache.timetables.items():
-        # railwayIdが指定されている場合はフィルタ
-        if railwayId:
-            # trip_idに路線情報が含まれているか簡易チェック
-            normalized_railway = normalize_railway_id(railwayId)
-            if normalized_railway and normalized_railway not in trip_id:
-                continue
-        
-        result[trip_id] = {
-            "stops": timetable["stops"]
-        }
-    
-    return result
+    railway_norm = normalize_railway_id(railwayId) if railwayId else None
+
+    # 時刻表は起動時ロード後に変化しないのでETag一致なら304
+    etag = None
+    headers = {"Cache-Control": "public, max-age=300"}
+    if cache.timetables_etag:
+        etag = f'"{cache.timetables_etag}-{railway_norm or "all"}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304)
+        headers["ETag"] = etag
+
+    # シリアライズ済みボディは時刻表が差し替わるまで再利用できる
+    body_key = railway_norm or "all"
+    body = cache.timetables_body_cache.get(body_key)
+    if body is None:
+        # 路線指定時は登録時に構築した路線別ビューを引くだけ（全件スキャンしない）
+        if railway_norm:
+            timetables = cache.timetables_by_railway.get(railway_norm, {})
+        else:
+            timetables = cache.timetables
+
+        # 全trip分の中間dictを組み立てず、tripごとに直列化してバッファへ連結する
+        # （ピークメモリをほぼボディサイズだけに抑える）
+        buf = bytearray(b"{")
+        first = True
+        for trip_id, tt in timetables.items():
+            if first:
+                first = False
+            else:
+                buf += b","
+            buf += orjson.dumps(trip_id)
+            buf += b':{"stops":'
+            buf += orjson.dumps(tt["stops"])
+            buf += b"}"
+        buf += b"}"
+        body = bytes(buf)
+        cache.timetables_body_cache[body_key] = body
+
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/api/trains/stream")
-async def api_trains_stream(request: Request, railwayId: Optional[str] = None):
-    """SSEでスナップショット配信"""
+async def api_trains_stream(request: Request, railwayId: Optional[str] = None, delta: bool = False):
+    """SSEでスナップショット配信
+
+    delta=1を指定したクライアントには、初回のsnapshotの後は前tickとの
+    差分（event: delta）だけを送る。既定は従来どおり毎回フルスナップショット。
+    """
     railway_norm = normalize_railway_id(railwayId) if railwayId else None
 
+    frame_key = railway_norm or "__ALL__"
+
+    def current_frame() -> bytes:
+        frame = cache.frame_bytes_by_railway.get(frame_key)
+        if frame is None:
+            # 未キャッシュの路線キーは従来どおり都度構築
+            data = cache.snapshot(railway_norm)
+            frame = SSE_SNAPSHOT_PREFIX + orjson.dumps(data) + SSE_TERM
+        return frame
+
     async def event_gen():
-        last_sent_seq = -1
-        last_hb = 0.0
-        while True:
-            if await request.is_disconnected():
-                break
-            snap = cache.snapshot(railway_norm)
-            if snap.seq != last_sent_seq:
-                data = snap.model_dump()
-                yield f"event: snapshot\n" + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
-                last_sent_seq = snap.seq
-                last_hb = time.time()
-            now = time.time()
-            if now - last_hb >= SSE_HEARTBEAT_SEC:
-                yield f"event: ping\n" + f"data: {unix_ts()}\n\n"
-                last_hb = now
-            await asyncio.sleep(0.2)
-
-    headers = {
-        "Cache-Control": "no-cache",
-        "Content-Type": "text/event-stream",
-        "Connection": "keep-alive",
-        "X-Accel-Buffering": "no",
-    }
-    return StreamingResponse(event_gen(), headers=headers, media_type="text/event-stream")
-@app.get("/api/timetables")
-async def get_timetables_api(railwayId: Optional[str] = None) -> Dict[str, Any]:
-    """
-    時刻表データをGTFS形式で返す
-    返却形式: { trip_id: { stops: [{stop_id, arrival, departure, sequence}] } }
-    """
-    result = {}
-    
-    for trip_id, timetable in cache.timetables.items():
-        # railwayIdが指定されている場合はフィルタ
-        if railwayId:
-            # trip_idに路線情報が含まれているか簡易チェック
-            normalized_railway = normalize_railway_id(railwayId)
-            if normalized_railway and normalized_railway not in trip_id:
-                continue
-        
-        result[trip_id] = {
-            "stops": timetable["stops"]
-        }
-    
-    return result
\ No newline at end of file
+        # ループ内で毎iterationグローバル・属性解決しないようローカルへ束縛
+        update_wait = cache.update_event.wait
+        wait_for = asyncio.wait_for
+        sleep = asyncio.sleep
+
+        # is_disconnected()のポーリングではなく、受信キューを監視する
+        # バックグラウンドタスクでhttp.disconnectを検知する
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while True:
+                msg = await request.receive()
+                if msg["type"] == "http.disconnect":
+                    disconnected.set()
+                    return
+
+        disc_task = asyncio.create_task(watch_disconnect())
+        disc_set = disconnected.is_set
+
+        try:
+            # 接続直後は現在のスナップショットを即送信
+            # （last_seqはyield再開まで実行されないので、yield前に読む）
+            last_seq = cache.seq
+            yield current_frame()
+            # yield直後に制御を返してイベントループにすぐフラッシュさせる
+            # （複数tick分がチャンクにまとめられて送られるのを防ぐ）
+            await sleep(0)
+            while not disc_set():
+                # poll_loopの更新通知を待つ。タイムアウトしたらping送信
+                try:
+                    await wait_for(update_wait(), timeout=SSE_HEARTBEAT_SEC)
+                except asyncio.TimeoutError:
+                    yield SSE_PING_PREFIX + str(unix_ts()).encode() + SSE_TERM
+                    await sleep(0)
+                    continue
+                # 短い猶予内に連続した更新は1フレームにまとめる（最新のフレームだけを送る）
+                if SSE_COALESCE_SEC > 0:
+                    await sleep(SSE_COALESCE_SEC)
+                if delta:
+                    # seqが連続しているときだけ差分を送れる。tickを取り逃した
+                    # （コアレス等でseqが飛んだ）場合はフルスナップショットへ戻す
+                    entry = cache.delta_frames_by_railway.get(frame_key)
+                    if entry is not None and entry[0] == last_seq + 1:
+                        yield entry[1]
+                        last_seq = entry[0]
+                        await sleep(0)
+                        continue
+                last_seq = cache.seq
+                yield current_frame()
+                await sleep(0)
+        finally:
+            disc_task.cancel()
+
+    return StreamingResponse(event_gen(), headers=SSE_HEADERS, media_type="text/event-stream")
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # loop/http="auto"はuvloop・httptoolsがインストールされていれば自動で使う
+    # （未インストール環境ではasyncio/h11にフォールバック）
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")), loop="auto", http="auto")
\ No newline at end of file